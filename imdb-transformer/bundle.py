@@ -0,0 +1,434 @@
+# Read-only binary bundle of the mrdatabase for the recommender service
+#
+# Layout of a bundle file (all numbers little endian):
+#
+#   magic        8 bytes  b'MRBUNDL\0'
+#   version      uint32
+#   header_len   uint32
+#   header       header_len bytes of utf-8 json {"meta": {...}, "arrays": {name: {dtype, shape, offset}}}
+#   arrays       raw numpy arrays, every array starts at a multiple of ALIGNMENT
+#
+# Bundle opens the file with mmap and hands out numpy views on it, nothing is copied
+# or parsed at startup. Worker processes which open the same file share its pages
+# through the page cache. Nightly builds are published next to each other and the
+# 'current' symlink is swapped atomically, BundleWatcher picks the new one up.
+import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+import sqlalchemy as sa
+import pandas as pd
+import numpy as np
+
+
+MAGIC = b'MRBUNDL\0'
+VERSION = 1
+ALIGNMENT = 64
+CURRENT_LINK = 'current'
+
+
+def imdb_ids(ids):
+    '''Convert IMDb ids like tt0111161 or nm0000001 to integers
+
+    ids: pandas series of str
+
+    return: numpy int64 array
+    '''
+    return ids.str.slice(2).astype('int64').to_numpy()
+
+
+def string_table(strings):
+    '''Encode strings into one utf-8 buffer with offsets
+
+    strings: pandas series of str, missing values become empty strings
+
+    return: tuple (offsets, data) of numpy uint64 and uint8 arrays, string i is data[offsets[i]:offsets[i + 1]]
+    '''
+    encoded = strings.fillna('').str.encode('utf-8')
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum(encoded.str.len().to_numpy(dtype=np.uint64), out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, data
+
+
+def csr(rows, cols, n_rows):
+    '''Build the indptr/indices arrays of a sorted, duplicate free adjacency
+
+    rows: numpy int array of row positions
+    cols: numpy int array of column positions
+    n_rows: int number of rows
+
+    return: tuple (indptr, indices) of numpy int64 and int32 arrays
+    '''
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    keep = np.ones(len(rows), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols = rows[keep], cols[keep]
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols.astype(np.int32)
+
+
+def positions(ids, sorted_ids, what):
+    '''Look up the positions of ids in a sorted id array, unknown ids are -1'''
+    pos = np.searchsorted(sorted_ids, ids)
+    pos[pos == len(sorted_ids)] = 0
+    found = sorted_ids[pos] == ids if len(sorted_ids) else np.zeros(len(ids), dtype=bool)
+    if not found.all():
+        logging.warning(f"{(~found).sum()} {what} are unknown and will be ignored")
+    return np.where(found, pos, -1)
+
+
+def build_arrays(titles, ratings, genres, names, credits):
+    '''Turn the tables of the mrdatabase into the arrays of a bundle
+
+    titles: pandas dataframe with the columns tconst, titleType, primaryTitle
+    ratings: pandas dataframe with the columns tconst, averageRating, numVotes
+    genres: pandas dataframe with the columns tconst, genre
+    names: pandas dataframe with the columns nconst, primaryName
+    credits: pandas dataframe with the int64 columns title_id, person_id (principals, directors and writers)
+
+    return: dictonary of type {str: numpy array}
+    '''
+    arrays = {}
+
+    titles = titles.assign(id=imdb_ids(titles['tconst'])).sort_values('id')
+    title_ids = titles['id'].to_numpy()
+    arrays['title_ids'] = title_ids
+    arrays['title_names.offsets'], arrays['title_names.data'] = string_table(titles['primaryTitle'])
+
+    title_types = titles['titleType'].astype('category')
+    arrays['title_types'] = title_types.cat.codes.to_numpy(dtype=np.int8)
+    arrays['title_type_names.offsets'], arrays['title_type_names.data'] = string_table(
+        pd.Series(title_types.cat.categories, dtype=object))
+
+    names = names.assign(id=imdb_ids(names['nconst'])).sort_values('id')
+    person_ids = names['id'].to_numpy()
+    arrays['person_ids'] = person_ids
+    arrays['person_names.offsets'], arrays['person_names.data'] = string_table(names['primaryName'])
+
+    rows = positions(imdb_ids(ratings['tconst']), title_ids, 'rated titles')
+    known = rows >= 0
+    arrays['average_rating'] = np.full(len(title_ids), np.nan, dtype=np.float32)
+    arrays['average_rating'][rows[known]] = ratings['averageRating'].to_numpy(dtype=np.float32)[known]
+    arrays['num_votes'] = np.zeros(len(title_ids), dtype=np.int32)
+    arrays['num_votes'][rows[known]] = ratings['numVotes'].fillna(0).to_numpy(dtype=np.int32)[known]
+
+    genre_names = pd.Series(sorted(genres['genre'].dropna().unique()), dtype=object)
+    arrays['genre_names.offsets'], arrays['genre_names.data'] = string_table(genre_names)
+    rows = positions(imdb_ids(genres['tconst']), title_ids, 'titles in title_genres')
+    cols = pd.Index(genre_names).get_indexer(genres['genre'])
+    known = (rows >= 0) & (cols >= 0)
+    arrays['title_genres.indptr'], arrays['title_genres.indices'] = csr(rows[known], cols[known], len(title_ids))
+
+    rows = positions(credits['title_id'].to_numpy(), title_ids, 'titles in the credits')
+    cols = positions(credits['person_id'].to_numpy(), person_ids, 'persons in the credits')
+    known = (rows >= 0) & (cols >= 0)
+    arrays['title_persons.indptr'], arrays['title_persons.indices'] = csr(rows[known], cols[known], len(title_ids))
+    arrays['person_titles.indptr'], arrays['person_titles.indices'] = csr(cols[known], rows[known], len(person_ids))
+
+    return arrays
+
+
+def read_credits(connection, chunksize=1000000):
+    '''Read the (title, person) pairs of principals, directors and writers as int ids
+
+    The union has tens of millions of rows. It is streamed in chunks and every chunk
+    is converted to int ids right away, the ids take a fraction of the memory of the
+    tconst/nconst strings.
+
+    connection: sqlalchemy connection to the mrdatabase
+    chunksize: int number of rows which are converted at once
+
+    return: pandas dataframe with the int64 columns title_id, person_id
+    '''
+    query = sa.text(
+        "SELECT tconst, nconst FROM title_principals "
+        "UNION SELECT tconst, nconst FROM title_directors "
+        "UNION SELECT tconst, nconst FROM title_writers"
+    )
+    chunks = []
+    # stream_results uses a server side cursor, the driver does not buffer the whole result.
+    # It is set for this statement only, connection.execution_options() would change the
+    # connection of the caller in place
+    result = connection.execute(query, execution_options={'stream_results': True})
+    for rows in result.partitions(chunksize):
+        chunk = pd.DataFrame(rows, columns=['tconst', 'nconst']).dropna()
+        chunks.append(pd.DataFrame({
+            'title_id': imdb_ids(chunk['tconst']),
+            'person_id': imdb_ids(chunk['nconst']),
+        }))
+    if not chunks:
+        return pd.DataFrame({'title_id': np.empty(0, dtype=np.int64), 'person_id': np.empty(0, dtype=np.int64)})
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_tables(connection):
+    '''Read the tables which go into a bundle from the mrdatabase
+
+    connection: sqlalchemy connection to the mrdatabase
+
+    return: dictonary with the keyword arguments of build_arrays
+    '''
+    queries = {
+        'titles': "SELECT tconst, titleType, primaryTitle FROM title_basics",
+        'ratings': "SELECT tconst, averageRating, numVotes FROM title_ratings",
+        'genres': "SELECT tconst, genre FROM title_genres",
+        'names': "SELECT nconst, primaryName FROM name_basics",
+    }
+    tables = {}
+    for name, query in queries.items():
+        logging.info(f"Read {name} for the bundle")
+        tables[name] = pd.read_sql(sa.text(query), con=connection)
+    logging.info("Read credits for the bundle")
+    tables['credits'] = read_credits(connection)
+    return tables
+
+
+def write_bundle(path, arrays, meta=None):
+    '''Write arrays into a bundle file
+
+    The file is written next to path and renamed afterwards, a reader never sees
+    a half written bundle.
+
+    path: str path of the bundle file
+    arrays: dictonary of type {str: numpy array}
+    meta: dictonary with json serializable information about the bundle
+    '''
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        entries[name] = {'dtype': array.dtype.newbyteorder('<').str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+
+    # the array offsets depend on the header length, fix them once it is known
+    def encode_header(start):
+        header = {'meta': meta or {}, 'arrays': {
+            name: dict(entry, offset=entry['offset'] + start) for name, entry in entries.items()
+        }}
+        return json.dumps(header).encode('utf-8')
+
+    prefix_len = len(MAGIC) + 8
+    start = 0
+    while True:
+        header = encode_header(start)
+        new_start = -(-(prefix_len + len(header)) // ALIGNMENT) * ALIGNMENT
+        if new_start == start:
+            break
+        start = new_start
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.write(b'\0' * (start + entries[name]['offset'] - f.tell()))
+            f.write(np.ascontiguousarray(array, dtype=entries[name]['dtype']).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def publish_bundle(path, bundle_dir, keep=3):
+    '''Point the current link of bundle_dir atomically to a new bundle
+
+    Older bundles are removed, processes which still have them mapped keep
+    reading them until they switch.
+
+    path: str path of the new bundle file inside bundle_dir
+    bundle_dir: str directory with the bundles and the current link
+    keep: int number of bundles which are kept
+    '''
+    link_path = os.path.join(bundle_dir, CURRENT_LINK)
+    tmp_link = f'{link_path}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(path), tmp_link)
+    os.replace(tmp_link, link_path)
+    logging.info(f"{link_path} -> {os.path.basename(path)}")
+
+    bundles = sorted(name for name in os.listdir(bundle_dir) if name.endswith('.bundle'))
+    for name in bundles[:-keep]:
+        os.remove(os.path.join(bundle_dir, name))
+
+
+def export_bundle(connection, bundle_dir, keep=3):
+    '''Export the mrdatabase into a new bundle and publish it
+
+    connection: sqlalchemy connection to the mrdatabase
+    bundle_dir: str directory with the bundles and the current link
+    keep: int number of bundles which are kept
+
+    return: str path of the new bundle
+    '''
+    os.makedirs(bundle_dir, exist_ok=True)
+    created = datetime.datetime.now()
+    arrays = build_arrays(**read_tables(connection))
+    path = os.path.join(bundle_dir, f"mr-{created:%Y%m%d-%H%M%S}.bundle")
+    write_bundle(path, arrays, meta={'created': created.isoformat()})
+    logging.info(f"Wrote {path} ({os.path.getsize(path) / 2**20:.0f} MiB)")
+    publish_bundle(path, bundle_dir, keep=keep)
+    return path
+
+
+class StringTable:
+    '''Strings of a bundle, decoded on access'''
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+
+class Bundle:
+    '''Memory mapped, read-only view of a bundle file
+
+    All arrays are numpy views on the mapping, opening a bundle only parses the
+    header. Positions (not IMDb ids) connect the arrays: title i has the rating
+    average_rating[i], the genres title_genres.indices[title_genres.indptr[i]:title_genres.indptr[i + 1]]
+    and so on.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        with open(self.path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a bundle")
+        version, header_len = struct.unpack_from('<II', self.mmap, len(MAGIC))
+        if version != VERSION:
+            raise ValueError(f"{self.path} has bundle version {version}, expected {VERSION}")
+        header_start = len(MAGIC) + 8
+        header = json.loads(self.mmap[header_start:header_start + header_len].decode('utf-8'))
+
+        self.meta = header['meta']
+        self.arrays = {}
+        for name, entry in header['arrays'].items():
+            dtype = np.dtype(entry['dtype'])
+            count = int(np.prod(entry['shape'], dtype=np.int64))
+            self.arrays[name] = np.frombuffer(
+                self.mmap, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+
+        self.title_ids = self.arrays['title_ids']
+        self.person_ids = self.arrays['person_ids']
+        self.average_rating = self.arrays['average_rating']
+        self.num_votes = self.arrays['num_votes']
+        self.title_types = self.arrays['title_types']
+        self.title_names = self.strings('title_names')
+        self.title_type_names = self.strings('title_type_names')
+        self.person_names = self.strings('person_names')
+        self.genre_names = self.strings('genre_names')
+
+    def strings(self, name):
+        return StringTable(self.arrays[f'{name}.offsets'], self.arrays[f'{name}.data'])
+
+    def adjacency(self, name):
+        '''Return the (indptr, indices) arrays of title_genres, title_persons or person_titles'''
+        return self.arrays[f'{name}.indptr'], self.arrays[f'{name}.indices']
+
+    def neighbours(self, name, i):
+        indptr, indices = self.adjacency(name)
+        return indices[indptr[i]:indptr[i + 1]]
+
+    def title_index(self, tconst):
+        '''Position of a tconst like tt0111161, -1 if it is not in the bundle'''
+        return self._index(self.title_ids, tconst)
+
+    def person_index(self, nconst):
+        '''Position of a nconst like nm0000001, -1 if it is not in the bundle'''
+        return self._index(self.person_ids, nconst)
+
+    @staticmethod
+    def _index(ids, imdb_id):
+        value = int(imdb_id[2:])
+        i = int(np.searchsorted(ids, value))
+        return i if i < len(ids) and ids[i] == value else -1
+
+    def tconst(self, i):
+        return f"tt{self.title_ids[i]:07d}"
+
+    def nconst(self, i):
+        return f"nm{self.person_ids[i]:07d}"
+
+    def __len__(self):
+        return len(self.title_ids)
+
+
+class BundleWatcher:
+    '''Follow the current link of a bundle directory
+
+    get() returns the bundle the link points to and reopens it once the link
+    was swapped to a new build. The old Bundle is not closed: requests which
+    still hold it keep working, the mapping is released with the last reference.
+
+    Structures derived from a bundle (e.g. recommender.bundle_feature_space) are
+    rebuilt by on_swap: it is called with every bundle that is opened and its
+    return value is handed out together with the bundle by snapshot(). The new
+    bundle is only used once on_swap succeeded, on a failure the old one is kept.
+    generation counts the swaps.
+
+    bundle_dir: str directory with the bundles and the current link
+    check_interval: float seconds between two checks of the link
+    on_swap: function bundle -> derived structure, None keeps no derived structure
+    '''
+
+    def __init__(self, bundle_dir, check_interval=5.0, on_swap=None):
+        self.link_path = os.path.join(bundle_dir, CURRENT_LINK)
+        self.check_interval = check_interval
+        self.on_swap = on_swap
+        self.generation = 0
+        # bundle and derived structure are replaced together, a reader never
+        # gets the structure of another build than the bundle
+        self.current = self._open(os.path.realpath(self.link_path))
+        self.checked = time.monotonic()
+
+    def _open(self, path):
+        bundle = Bundle(path)
+        return bundle, self.on_swap(bundle) if self.on_swap else None
+
+    def snapshot(self):
+        '''Return the tuple (bundle, derived structure) of the current build'''
+        now = time.monotonic()
+        if now - self.checked >= self.check_interval:
+            self.checked = now
+            path = os.path.realpath(self.link_path)
+            if path != self.current[0].path:
+                logging.info(f"switch to bundle {path}")
+                try:
+                    self.current = self._open(path)
+                    self.generation += 1
+                except Exception:
+                    logging.exception(f"could not switch to {path}, keep {self.current[0].path}")
+        return self.current
+
+    def get(self):
+        return self.snapshot()[0]
+
+
+if __name__ == '__main__':
+
+    execution_path = os.path.dirname(os.path.realpath(__file__))
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s :: %(asctime)s :: %(message)s')
+
+    bundle_dir = f'{execution_path}/bundles'
+    start = time.perf_counter()
+    bundle = Bundle(os.path.join(bundle_dir, CURRENT_LINK))
+    logging.info(f"Opened {bundle.path} in {(time.perf_counter() - start) * 1000:.1f}ms")
+    logging.info(bundle.meta)
+    logging.info(f"{len(bundle)} titles, {len(bundle.person_ids)} persons, {len(bundle.genre_names)} genres")
+    for name, array in bundle.arrays.items():
+        logging.info(f"{name:<28} {array.dtype.str:<5} {array.nbytes / 2**20:>10.1f} MiB")
@@ -2,7 +2,6 @@ import csv
 import logging
 import datetime
 import os
-from multiprocessing import Pool
 
 
 import sqlalchemy as sa
@@ -292,6 +291,12 @@ def csv2sql(file_path, filename, table_name, dtypes, connection,
             explode=None, 
             rename=None,
             check_foreign_keys=None):
+    '''Load a *.tsv file chunkwise into a sql table
+
+    The chunks are written one after another on the given connection, a live
+    connection and the tqdm bar can not be shared with a process pool.
+    mr-db-transformer.py loads several tables in parallel instead.
+    '''
     if specific_parameters is None:
         specific_parameters = {}
     
@@ -307,7 +312,7 @@ def csv2sql(file_path, filename, table_name, dtypes, connection,
     }
     logging.info(f"Reading {filename} into {table_name}")
     num_rows = sum(1 for line in open(f'{file_path}/{filename}'))
-    with tqdm(total=num_rows) as pbar:
+    with tqdm(total=num_rows, desc=table_name) as pbar:
         df = pd.read_csv(
                 f"{file_path}/{filename}",
                 usecols=dtypes.keys(),
@@ -315,9 +320,8 @@ def csv2sql(file_path, filename, table_name, dtypes, connection,
                 **specific_parameters,
                 **general_parameters,
         )
-        # for chunk in df:
-        with Pool(6) as p:
-            p.map(process_chunk, [(chunk, table_name, connection, explode, rename, pbar) for chunk in df])
+        for chunk in df:
+            process_chunk(chunk, table_name, connection, explode, rename, pbar)
     
 def process_chunk(chunk, table_name, connection, explode, rename, pbar):            
     if explode:
@@ -329,6 +333,10 @@ def process_chunk(chunk, table_name, connection, explode, rename, pbar):
         chunk.rename(columns=rename, inplace=True)
 
     chunk.to_sql(table_name, con=connection, index=False, if_exists='append')
+    # commit every chunk, a failure late in a big table keeps the rows loaded so far
+    # and the transactions stay small. The transaction is begun by the caller's
+    # execute (e.g. SET foreign_key_checks), to_sql does not commit it then
+    connection.commit()
     pbar.update(len(chunk))
 
 
@@ -425,6 +433,76 @@ name_primaryProfessions_dtypes = {
     'primaryProfession': 'string',
 }
 
+# one csv2sql call per sql table, in the order create_database.py loads them
+table_loads = [
+    {
+        'filename': 'title.basics.tsv',
+        'table_name': 'title_basics',
+        'dtypes': title_basics_dtypes,
+    },
+    {
+        'filename': 'name.basics.tsv',
+        'table_name': 'name_basics',
+        'dtypes': name_basics_dtypes,
+    },
+    {
+        'filename': 'title.episode.tsv',
+        'table_name': 'title_episode',
+        'dtypes': title_episode_dtypes,
+    },
+    {
+        'filename': 'title.akas.tsv',
+        'table_name': 'title_akas',
+        'dtypes': title_akas_dtypes,
+        'rename': {'titleId': 'tconst'},
+    },
+    {
+        'filename': 'title.ratings.tsv',
+        'table_name': 'title_ratings',
+        'dtypes': title_ratings_dtypes,
+    },
+    {
+        'filename': 'title.principals.tsv',
+        'table_name': 'title_principals',
+        'dtypes': title_principals_dtypes,
+    },
+    {
+        'filename': 'title.basics.tsv',
+        'table_name': 'title_genres',
+        'dtypes': title_genres_dtypes,
+        'explode': 'genres',
+        'rename': {'genres': 'genre'},
+    },
+    {
+        'filename': 'title.crew.tsv',
+        'table_name': 'title_directors',
+        'dtypes': title_directors_dtypes,
+        'explode': 'directors',
+        'rename': {'directors': 'nconst'},
+    },
+    {
+        'filename': 'title.crew.tsv',
+        'table_name': 'title_writers',
+        'dtypes': title_writers_dtypes,
+        'explode': 'writers',
+        'rename': {'writers': 'nconst'},
+    },
+    {
+        'filename': 'name.basics.tsv',
+        'table_name': 'name_known_for_titles',
+        'dtypes': name_knownForTitles_dtypes,
+        'explode': 'knownForTitles',
+        'rename': {'knownForTitles': 'tconst'},
+    },
+    {
+        'filename': 'name.basics.tsv',
+        'table_name': 'name_primary_professions',
+        'dtypes': name_primaryProfessions_dtypes,
+        'explode': 'primaryProfession',
+        'rename': {'primaryProfession': 'profession'},
+    },
+]
+
 
 if __name__ == '__main__':
 
@@ -500,115 +578,12 @@ if __name__ == '__main__':
 
     file_path=f'{execution_path}/tsv_dump'
 
-    csv2sql(
-        file_path=file_path,
-        filename='title.basics.tsv',
-        table_name='title_basics',
-        dtypes=title_basics_dtypes,
-        connection=db_conncetion,
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='name.basics.tsv',
-        table_name='name_basics',
-        dtypes=name_basics_dtypes,
-        connection=db_conncetion,
-    )
-
-
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.episode.tsv',
-        table_name='title_episode',
-        dtypes=title_episode_dtypes,
-        connection=db_conncetion,
-        #check_foreign_keys={'parentTconst': title_basics_keys,
-         #                   'tconst': title_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.akas.tsv',
-        table_name='title_akas',
-        dtypes=title_akas_dtypes,
-        connection=db_conncetion,
-        rename= {'titleId': 'tconst'},
-       # check_foreign_keys={'tconst': title_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.ratings.tsv',
-        table_name='title_ratings',
-        dtypes=title_ratings_dtypes,
-        connection=db_conncetion,
-        # check_foreign_keys={'tconst': title_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.principals.tsv',
-        table_name='title_principals',
-        dtypes=title_principals_dtypes,
-        connection=db_conncetion,
-        # check_foreign_keys={'tconst': title_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.basics.tsv',
-        table_name='title_genres',
-        dtypes=title_genres_dtypes,
-        connection=db_conncetion,
-        explode='genres',
-        rename={'genres': 'genre'},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.crew.tsv',
-        table_name='title_directors',
-        dtypes=title_directors_dtypes,
-        connection=db_conncetion,
-        explode='directors',
-        rename={'directors': 'nconst'},
-       # check_foreign_keys={'nconst': name_basics_keys, 'tconst': title_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='title.crew.tsv',
-        table_name='title_writers',
-        dtypes=title_writers_dtypes,
-        connection=db_conncetion,
-        explode='writers',
-        rename={'writers': 'nconst'},
-       # check_foreign_keys={'nconst': name_basics_keys, 'tconst': title_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='name.basics.tsv',
-        table_name='name_known_for_titles',
-        dtypes=name_knownForTitles_dtypes,
-        connection=db_conncetion,
-        explode='knownForTitles',
-        rename={'knownForTitles': 'tconst'},
-        # check_foreign_keys={'tconst': title_basics_keys, 'nconst': name_basics_keys},
-    )
-
-    csv2sql(
-        file_path=file_path,
-        filename='name.basics.tsv',
-        table_name='name_primary_professions',
-        dtypes=name_primaryProfessions_dtypes,
-        connection=db_conncetion,
-        explode='primaryProfession',
-        rename={'primaryProfession': 'profession'},
-        # check_foreign_keys={'nconst': name_basics_keys},
-    )
+    for table_load in table_loads:
+        csv2sql(
+            file_path=file_path,
+            connection=db_conncetion,
+            **table_load,
+        )
 
     logging.info("Done")
     end = datetime.datetime.now()
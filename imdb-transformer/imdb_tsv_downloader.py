@@ -27,58 +27,72 @@ file_path_list = [
     "./tsv_dump/title.ratings.tsv.gz",
 ]
 
-print("IMDb TSV Downloader / Updater v1.0")
-print("Downloading and unpacking IMDb TSV files...")
-
-# Überprüfe, ob die Gzip-Dateien vorhanden sind und lade sie herunter, falls nicht
-for url, file_path in zip(url_list, file_path_list):
-    if not os.path.isfile(file_path):
-        print(f"{file_path} not found, downloading...")
-        response = requests.get(url, stream=True)
-        total_length = response.headers.get('content-length')
-        if total_length is None: # no content length header
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            print(f"{file_path} downloaded.")
-        else:
-            with open(file_path, "wb") as f:
-                dl = 0
-                total_length = int(total_length)
-                with tqdm(total=total_length) as pbar:
-                    for data in response.iter_content(chunk_size=4096):
-                        f.write(data)
-                        pbar.update(4096)
-            print(f"\r{file_path} downloaded.")
-    else:
+
+# Lade eine Gzip-Datei herunter, falls sie noch nicht vorhanden ist
+def download_file(url, file_path):
+    if os.path.isfile(file_path):
         print(f"{file_path} already exists.")
+        return
+
+    print(f"{file_path} not found, downloading...")
+    # erst in eine .part Datei schreiben, damit ein abgebrochener Download nicht als fertig gilt
+    part_path = f"{file_path}.part"
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    total_length = response.headers.get('content-length')
+    with open(part_path, "wb") as f:
+        with tqdm(total=int(total_length) if total_length else None,
+                  unit='B', unit_scale=True, desc=os.path.basename(file_path)) as pbar:
+            for data in response.iter_content(chunk_size=1 << 20):
+                f.write(data)
+                pbar.update(len(data))
+    os.replace(part_path, file_path)
+    print(f"\r{file_path} downloaded.")
+
 
 # Entpacke die Gzip-Dateien mit progress bar
-def ungzip_file(input_path, output_path):
+def ungzip_file(input_path, output_path, chunk_size=1 << 20):
+    # wie beim Download erst in eine .part Datei schreiben, eine abgebrochene
+    # Entpackung hinterlässt sonst eine abgeschnittene .tsv Datei
+    part_path = f"{output_path}.part"
     with gzip.open(input_path, 'rb') as infile:
-        with open(output_path, 'wb') as outfile:
-            # Bestimme die Größe der gzip-Datei
-            file_size = infile.seek(0, 2)
-            infile.seek(0)
-            # Erstelle den Fortschrittsbalken
-            progress_bar = tqdm(total=file_size, unit='B', unit_scale=True)
+        with open(part_path, 'wb') as outfile:
+            # Der Fortschritt wird an der gelesenen Gzip-Datei gemessen, die entpackte
+            # Größe zu bestimmen würde die Datei ein zweites Mal entpacken
+            file_size = os.path.getsize(input_path)
+            progress_bar = tqdm(total=file_size, unit='B', unit_scale=True, desc=os.path.basename(output_path))
+            position = 0
             # Entpacke die Datei und schreibe sie in die Ausgabedatei
             while True:
-                chunk = infile.read(1024)
+                chunk = infile.read(chunk_size)
                 if not chunk:
                     break
                 outfile.write(chunk)
                 # Aktualisiere den Fortschrittsbalken
-                progress_bar.update(len(chunk))
+                new_position = infile.fileobj.tell()
+                progress_bar.update(new_position - position)
+                position = new_position
             # Schließe den Fortschrittsbalken
             progress_bar.close()
-            print(f"{input_path} unpacked.")
+    os.replace(part_path, output_path)
+    print(f"{input_path} unpacked.")
+
+
+if __name__ == '__main__':
+
+    print("IMDb TSV Downloader / Updater v1.0")
+    print("Downloading and unpacking IMDb TSV files...")
+
+    # Überprüfe, ob die Gzip-Dateien vorhanden sind und lade sie herunter, falls nicht
+    for url, file_path in zip(url_list, file_path_list):
+        download_file(url, file_path)
+
+    for file_path in file_path_list:
+        ungzip_file(file_path, file_path[:-3])
 
-for file_path in file_path_list:
-    ungzip_file(file_path, file_path[:-3])
-    
-# löschen der Gzip-Dateien
-for file_path in file_path_list:
-    os.remove(file_path)
-    print(f"{file_path} deleted.")  # Ausgabe: ./tsv_dump/name.basics.tsv.gz deleted.
+    # löschen der Gzip-Dateien
+    for file_path in file_path_list:
+        os.remove(file_path)
+        print(f"{file_path} deleted.")  # Ausgabe: ./tsv_dump/name.basics.tsv.gz deleted.
 
-print("Done.")
\ No newline at end of file
+    print("Done.")
@@ -1,4 +1,246 @@
 # Entry Point for the transformation of the data from the IMDB dataset
-print("hello world !!!!!")
+#
+# Runs download -> decompress -> load of the IMDb dump as one pipeline. Every file
+# and every sql table is a step in a dependency graph, independent steps run
+# concurrently: title.ratings can already be loaded while title.principals is
+# still downloading.
+import argparse
+import datetime
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-import imdb_tsv_downloader.py
+import sqlalchemy as sa
+
+import bundle
+import create_database
+import imdb_tsv_downloader
+
+
+Step = namedtuple('Step', ['name', 'func', 'depends_on'])
+StepResult = namedtuple('StepResult', ['name', 'status', 'start', 'end'])
+
+
+def build_steps(tsv_path, db_engine, metadata_obj, skip_download=False, keep_gz=False,
+                foreign_key_checks=False, bundle_dir=None):
+    '''Build the dependency graph of the pipeline
+
+    tsv_path: str path to the directory of the IMDb dump
+    db_engine: sqlalchemy engine, every load step opens its own connection
+    metadata_obj: sqlalchemy MetaData with the tables of create_database.define_sql_tables
+    skip_download: bool use the *.tsv files which are already in tsv_path
+    keep_gz: bool do not delete the *.gz files after decompressing them
+    foreign_key_checks: bool load the parent tables (title_basics, name_basics) before
+        their child tables and keep the foreign key checks of MySQL enabled
+    bundle_dir: str export a bundle for the recommender service into this directory
+        once all tables are loaded, None skips the export
+
+    return: dictonary of type {str: Step}
+    '''
+    steps = {}
+
+    def add(name, func, depends_on=()):
+        steps[name] = Step(name, func, tuple(depends_on))
+
+    def create_tables():
+        metadata_obj.drop_all(db_engine)
+        metadata_obj.create_all(db_engine)
+
+    add('create_tables', create_tables)
+
+    filenames = sorted({table_load['filename'] for table_load in create_database.table_loads})
+    for filename in filenames:
+        if skip_download:
+            continue
+        url = next(url for url in imdb_tsv_downloader.url_list if url.endswith(f'/{filename}.gz'))
+        gz_path = f'{tsv_path}/{filename}.gz'
+
+        def decompress(gz_path=gz_path, tsv_file=f'{tsv_path}/{filename}'):
+            imdb_tsv_downloader.ungzip_file(gz_path, tsv_file)
+            if not keep_gz:
+                os.remove(gz_path)
+
+        add(f'download:{filename}.gz', lambda url=url, gz_path=gz_path: imdb_tsv_downloader.download_file(url, gz_path))
+        add(f'decompress:{filename}', decompress, [f'download:{filename}.gz'])
+
+    loaded_tables = {table_load['table_name'] for table_load in create_database.table_loads}
+    for table_load in create_database.table_loads:
+        table_name = table_load['table_name']
+        depends_on = ['create_tables']
+        if not skip_download:
+            depends_on.append(f"decompress:{table_load['filename']}")
+        if foreign_key_checks:
+            parents = {fk.column.table.name for fk in metadata_obj.tables[table_name].foreign_keys}
+            depends_on += [f'load:{parent}' for parent in sorted(parents & loaded_tables - {table_name})]
+
+        def load(table_load=table_load):
+            with db_engine.connect() as connection:
+                if not foreign_key_checks:
+                    connection.execute(sa.text("SET foreign_key_checks = 0;"))
+                create_database.csv2sql(
+                    file_path=tsv_path,
+                    connection=connection,
+                    **table_load,
+                )
+
+        add(f'load:{table_name}', load, depends_on)
+
+    if bundle_dir:
+        def export():
+            with db_engine.connect() as connection:
+                bundle.export_bundle(connection, bundle_dir)
+
+        add('export:bundle', export, [f'load:{table_name}' for table_name in sorted(loaded_tables)])
+
+    return steps
+
+
+def plan(steps):
+    '''Order the steps into stages, every step only depends on steps of earlier stages
+
+    steps: dictonary of type {str: Step}
+
+    return: list of lists of step names
+    '''
+    stages = []
+    done = set()
+    remaining = dict(steps)
+    while remaining:
+        stage = sorted(name for name, step in remaining.items() if set(step.depends_on) <= done)
+        if not stage:
+            raise ValueError(f"dependency cycle or unknown dependency in {sorted(remaining)}")
+        stages.append(stage)
+        done.update(stage)
+        for name in stage:
+            del remaining[name]
+    return stages
+
+
+def run(steps, workers=4):
+    '''Run the steps concurrently as soon as all their dependencies are done
+
+    A failed step is logged, the steps which depend on it are skipped and all
+    independent steps still run.
+
+    steps: dictonary of type {str: Step}
+    workers: int number of steps which run at the same time
+
+    return: list of StepResult in the order the steps finished
+    '''
+    plan(steps)  # fail early on cycles
+
+    results = {}
+    pending = dict(steps)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name, step in list(pending.items()):
+                dependency_status = [results[d].status for d in step.depends_on if d in results]
+                if any(status != 'done' for status in dependency_status):
+                    now = time.perf_counter()
+                    results[name] = StepResult(name, 'skipped', now, now)
+                    del pending[name]
+                    logging.warning(f"skip {name}, a dependency failed")
+                elif len(dependency_status) == len(step.depends_on) and len(running) < workers:
+                    # only submit to a free worker, the step starts now and its
+                    # duration does not include time waiting in the executor queue
+                    logging.info(f"start {name}")
+                    running[executor.submit(step.func)] = (name, time.perf_counter())
+                    del pending[name]
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, start = running.pop(future)
+                end = time.perf_counter()
+                try:
+                    future.result()
+                    status = 'done'
+                    logging.info(f"finished {name} in {end - start:.1f}s")
+                except Exception:
+                    status = 'failed'
+                    logging.exception(f"{name} failed")
+                results[name] = StepResult(name, status, start, end)
+
+    return sorted(results.values(), key=lambda result: result.end)
+
+
+def log_summary(results, wall_time):
+    '''Log the timing of every step and how much the steps overlapped'''
+    logging.info(f"{'step':<40} {'status':<8} {'start':>8} {'duration':>9}")
+    first_start = min((result.start for result in results), default=0)
+    for result in sorted(results, key=lambda result: result.start):
+        logging.info(
+            f"{result.name:<40} {result.status:<8} "
+            f"{result.start - first_start:>7.1f}s {result.end - result.start:>8.1f}s"
+        )
+    step_time = sum(result.end - result.start for result in results)
+    logging.info(f"wall time {wall_time:.1f}s, summed step time {step_time:.1f}s")
+
+
+if __name__ == '__main__':
+
+    execution_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser(description='Download the IMDb dump and load it into the mrdatabase')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan of the pipeline')
+    parser.add_argument('--workers', type=int, default=4, help='number of steps which run at the same time')
+    parser.add_argument('--tsv-path', default=f'{execution_path}/tsv_dump')
+    parser.add_argument('--skip-download', action='store_true', help='load the *.tsv files which are already in --tsv-path')
+    parser.add_argument('--keep-gz', action='store_true', help='keep the *.gz files after decompressing them')
+    parser.add_argument('--foreign-key-checks', action='store_true',
+                        help='load parent tables before their child tables and keep the foreign key checks enabled')
+    parser.add_argument('--bundle-dir', default=f'{execution_path}/bundles',
+                        help='export the bundle for the recommender service into this directory')
+    parser.add_argument('--skip-bundle', action='store_true', help='do not export a bundle')
+    parser.add_argument('--sql-user', default='root')
+    parser.add_argument('--sql-pass', default='myrootpassword')
+    parser.add_argument('--sql-host', default='localhost')
+    parser.add_argument('--sql-db', default='mrdatabase')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, filename=f'{execution_path}/mr-db-transformer.log', format='%(levelname)s :: %(message)s')
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter('%(levelname)s :: %(asctime)s :: %(message)s'))
+    logger = logging.getLogger()
+    logger.addHandler(console_handler)
+
+    metadata_obj = sa.MetaData()
+    create_database.define_sql_tables(metadata_obj)
+
+    db_connection_str = f'mysql+pymysql://{args.sql_user}:{args.sql_pass}@{args.sql_host}/{args.sql_db}?charset=utf8mb4'
+    db_engine = sa.create_engine(db_connection_str, pool_size=args.workers)
+
+    steps = build_steps(
+        args.tsv_path,
+        db_engine,
+        metadata_obj,
+        skip_download=args.skip_download,
+        keep_gz=args.keep_gz,
+        foreign_key_checks=args.foreign_key_checks,
+        bundle_dir=None if args.skip_bundle else args.bundle_dir,
+    )
+
+    if args.dry_run:
+        for number, stage in enumerate(plan(steps), start=1):
+            print(f"stage {number}")
+            for name in stage:
+                depends_on = ', '.join(steps[name].depends_on) or '-'
+                print(f"    {name:<40} after: {depends_on}")
+    else:
+        os.makedirs(args.tsv_path, exist_ok=True)
+        logging.info("Start")
+        now = datetime.datetime.now()
+        results = run(steps, workers=args.workers)
+        log_summary(results, (datetime.datetime.now() - now).total_seconds())
+        failed = [result.name for result in results if result.status != 'done']
+        if failed:
+            logging.error(f"not finished: {', '.join(failed)}")
+            raise SystemExit(1)
+        logging.info("Done")
@@ -0,0 +1,364 @@
+import logging
+import datetime
+import os
+
+import sqlalchemy as sa
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+
+class FeatureSpace:
+    '''Sparse title x feature matrix built from the ingested tables
+
+    Features are ordered by the number of titles they appear in. The first n_dense
+    features (genres and the like) touch a large share of the catalogue and are kept
+    as a dense block, scoring them is a plain BLAS matrix product. The long tail of
+    persons stays sparse.
+
+    tconsts: pandas Index of the titles in the catalogue, position == row in matrix
+    features: pandas Index of the feature labels ('genre:Drama', 'person:nm0000001', ...)
+    matrix: scipy csr_matrix (titles x features), rows are L2 normalized
+    n_dense: int number of leading features which are scored densely
+    popularity: numpy float32 array with a [0, 1] rating prior per title
+    '''
+
+    def __init__(self, tconsts, features, matrix, n_dense, popularity):
+        self.tconsts = tconsts
+        self.features = features
+        self.matrix = matrix
+        self.n_dense = n_dense
+        self.popularity = popularity
+        self.dense_t = np.ascontiguousarray(matrix[:, :n_dense].toarray().T)
+        self.sparse_t = matrix[:, n_dense:].T.tocsr()
+
+    def __len__(self):
+        return len(self.tconsts)
+
+
+def read_catalogue(connection, title_types=('movie',), min_votes=100):
+    '''Read the titles which can be recommended
+
+    connection: sqlalchemy connection to the mrdatabase
+    title_types: tuple of titleType values which should be part of the catalogue
+    min_votes: int titles with less votes in title_ratings are ignored
+
+    return: pandas dataframe with the columns tconst, averageRating, numVotes
+    '''
+    query = sa.text(
+        "SELECT b.tconst, r.averageRating, r.numVotes "
+        "FROM title_basics b JOIN title_ratings r ON b.tconst = r.tconst "
+        "WHERE b.titleType IN :title_types AND r.numVotes >= :min_votes"
+    ).bindparams(sa.bindparam('title_types', expanding=True))
+    return pd.read_sql(
+        query,
+        con=connection,
+        params={'title_types': list(title_types), 'min_votes': min_votes},
+    )
+
+
+def read_edges(connection, table_name, feature_column, prefix, title_types=('movie',)):
+    '''Read (tconst, feature) pairs of a child table of title_basics
+
+    connection: sqlalchemy connection to the mrdatabase
+    table_name: str name of the child table, e.g. title_genres
+    feature_column: str column which holds the feature value, e.g. genre or nconst
+    prefix: str prefix of the feature label, keeps genres and persons apart
+    title_types: tuple of titleType values which should be part of the catalogue
+
+    return: pandas dataframe with the columns tconst, feature
+    '''
+    query = sa.text(
+        f"SELECT DISTINCT t.tconst, t.{feature_column} AS feature "
+        f"FROM {table_name} t JOIN title_basics b ON t.tconst = b.tconst "
+        f"WHERE b.titleType IN :title_types AND t.{feature_column} IS NOT NULL"
+    ).bindparams(sa.bindparam('title_types', expanding=True))
+    edges = pd.read_sql(query, con=connection, params={'title_types': list(title_types)})
+    edges['feature'] = prefix + edges['feature']
+    return edges
+
+
+def build_feature_space(catalogue, edges, feature_weights=None, min_titles_per_feature=2,
+                        dense_share=0.01):
+    '''Build the title x feature matrix of the catalogue
+
+    Every feature gets an idf weight log(n_titles / n_titles_with_feature), scaled by
+    the weight of its prefix. Features which appear in less than min_titles_per_feature
+    titles can not connect two titles and are dropped to keep the matrix small.
+
+    catalogue: pandas dataframe as returned by read_catalogue
+    edges: list of pandas dataframes as returned by read_edges
+    feature_weights: dictonary of type {prefix: float}, defaults to 1.0 per prefix
+    min_titles_per_feature: int minimal document frequency of a feature
+    dense_share: float features which appear in at least this share of the titles are scored densely
+
+    return: FeatureSpace
+    '''
+    if feature_weights is None:
+        feature_weights = {}
+
+    tconsts = pd.Index(catalogue['tconst'])
+    # a person can be credited in title_principals and title_directors/title_writers,
+    # count every (title, feature) pair once for the document frequency and the weight
+    edges = pd.concat(edges, ignore_index=True).drop_duplicates(['tconst', 'feature'])
+
+    rows = tconsts.get_indexer(edges['tconst'])
+    edges = edges[rows >= 0]
+    rows = rows[rows >= 0]
+
+    feature_count = edges['feature'].value_counts()
+    feature_count = feature_count[feature_count >= min_titles_per_feature]
+    features = pd.Index(feature_count.index)
+    cols = features.get_indexer(edges['feature'])
+    keep = cols >= 0
+    rows, cols = rows[keep], cols[keep]
+    # value_counts is sorted descending, the dense features are a prefix of the columns
+    n_dense = int((feature_count >= dense_share * len(tconsts)).sum())
+    logging.info(f"{len(tconsts)} titles, {len(features)} features ({n_dense} dense), {len(rows)} edges")
+
+    prefix = features.str.split(':', n=1).str[0]
+    prefix_weight = prefix.map(lambda p: feature_weights.get(p, 1.0)).to_numpy(dtype=np.float32)
+    idf = np.log(len(tconsts) / feature_count.to_numpy(dtype=np.float32)).astype(np.float32)
+    weights = idf * prefix_weight
+
+    matrix = sp.csr_matrix(
+        (weights[cols], (rows, cols)),
+        shape=(len(tconsts), len(features)),
+        dtype=np.float32,
+    )
+    matrix = normalize_rows(matrix)
+
+    # bayesian average, titles with few votes are pulled towards the mean rating
+    votes = catalogue['numVotes'].to_numpy(dtype=np.float32)
+    rating = catalogue['averageRating'].to_numpy(dtype=np.float32)
+    prior_votes = np.float32(np.median(votes)) if len(votes) else np.float32(0)
+    mean_rating = np.float32(rating.mean()) if len(rating) else np.float32(0)
+    weighted = (votes * rating + prior_votes * mean_rating) / (votes + prior_votes)
+    popularity = (weighted / np.float32(10)).astype(np.float32)
+
+    return FeatureSpace(tconsts, features, matrix, n_dense, popularity)
+
+
+def load_feature_space(connection, title_types=('movie',), min_votes=100,
+                       feature_weights=None, min_titles_per_feature=2, dense_share=0.01):
+    '''Read the ingested tables and build the FeatureSpace of the catalogue
+
+    connection: sqlalchemy connection to the mrdatabase
+    title_types: tuple of titleType values which should be part of the catalogue
+    min_votes: int titles with less votes in title_ratings are ignored
+    feature_weights: dictonary of type {prefix: float}
+    min_titles_per_feature: int minimal document frequency of a feature
+    dense_share: float features which appear in at least this share of the titles are scored densely
+
+    return: FeatureSpace
+    '''
+    if feature_weights is None:
+        feature_weights = {'genre': 1.0, 'person': 0.5}
+
+    logging.info("Read catalogue")
+    catalogue = read_catalogue(connection, title_types=title_types, min_votes=min_votes)
+
+    edges = []
+    for table_name, feature_column, prefix in [
+        ('title_genres', 'genre', 'genre:'),
+        ('title_principals', 'nconst', 'person:'),
+        ('title_directors', 'nconst', 'person:'),
+        ('title_writers', 'nconst', 'person:'),
+    ]:
+        logging.info(f"Read {table_name}")
+        edges.append(read_edges(connection, table_name, feature_column, prefix, title_types=title_types))
+
+    return build_feature_space(
+        catalogue,
+        edges,
+        feature_weights=feature_weights,
+        min_titles_per_feature=min_titles_per_feature,
+        dense_share=dense_share,
+    )
+
+
+def bundle_feature_space(bundle, title_types=('movie',), min_votes=100,
+                         feature_weights=None, min_titles_per_feature=2, dense_share=0.01):
+    '''Build the FeatureSpace of the catalogue from a bundle instead of the mrdatabase
+
+    bundle: bundle.Bundle
+    title_types: tuple of titleType values which should be part of the catalogue
+    min_votes: int titles with less votes are ignored
+    feature_weights: dictonary of type {prefix: float}
+    min_titles_per_feature: int minimal document frequency of a feature
+    dense_share: float features which appear in at least this share of the titles are scored densely
+
+    return: FeatureSpace
+    '''
+    if feature_weights is None:
+        feature_weights = {'genre': 1.0, 'person': 0.5}
+
+    type_codes = [i for i in range(len(bundle.title_type_names)) if bundle.title_type_names[i] in title_types]
+    # unrated titles have a NaN rating, the mysql path drops them with its JOIN title_ratings
+    in_catalogue = (np.isin(bundle.title_types, type_codes) & (bundle.num_votes >= min_votes)
+                    & np.isfinite(bundle.average_rating))
+    rows = np.flatnonzero(in_catalogue)
+    tconsts = pd.Series(bundle.title_ids[rows]).map('tt{:07d}'.format)
+    catalogue = pd.DataFrame({
+        'tconst': tconsts,
+        'averageRating': bundle.average_rating[rows],
+        'numVotes': bundle.num_votes[rows],
+    })
+
+    def edges(name, label):
+        indptr, indices = bundle.adjacency(name)
+        counts = indptr[rows + 1] - indptr[rows]
+        # positions of the catalogue rows in indices, without a python loop over the titles
+        first = np.repeat(indptr[rows] - (np.cumsum(counts) - counts), counts)
+        cols = indices[first + np.arange(counts.sum())]
+        features, inverse = np.unique(cols, return_inverse=True)
+        return pd.DataFrame({
+            'tconst': np.repeat(tconsts.to_numpy(), counts),
+            'feature': np.array([label(i) for i in features], dtype=object)[inverse],
+        })
+
+    return build_feature_space(
+        catalogue,
+        [
+            edges('title_genres', lambda i: f'genre:{bundle.genre_names[i]}'),
+            edges('title_persons', lambda i: f'person:{bundle.nconst(i)}'),
+        ],
+        feature_weights=feature_weights,
+        min_titles_per_feature=min_titles_per_feature,
+        dense_share=dense_share,
+    )
+
+
+def normalize_rows(matrix):
+    '''L2 normalize the rows of a csr_matrix, empty rows stay empty'''
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sp.csr_matrix(sp.diags(1 / norms, dtype=np.float32) @ matrix, dtype=np.float32)
+
+
+def liked_matrix(space, liked):
+    '''Map the liked tconst lists of many users to a sparse user x title matrix
+
+    space: FeatureSpace
+    liked: list of lists of tconst, one list per user
+
+    return: scipy csr_matrix (users x titles) with 1 for every liked title
+    '''
+    lengths = np.fromiter((len(titles) for titles in liked), dtype=np.int64, count=len(liked))
+    users = np.repeat(np.arange(len(liked)), lengths)
+    flat = [tconst for titles in liked for tconst in titles]
+    cols = space.tconsts.get_indexer(pd.Index(flat, dtype=object)) if flat else np.empty(0, dtype=np.int64)
+
+    unknown = cols < 0
+    if unknown.any():
+        logging.warning(f"{unknown.sum()} liked titles are not in the catalogue and will be ignored")
+    users, cols = users[~unknown], cols[~unknown]
+
+    matrix = sp.csr_matrix(
+        (np.ones(len(cols), dtype=np.float32), (users, cols)),
+        shape=(len(liked), len(space)),
+    )
+    # duplicates in a liked list are summed up by csr_matrix, count them once
+    matrix.data[:] = 1
+    return matrix
+
+
+def build_profiles(space, liked):
+    '''Build the taste profile vectors of many users at once
+
+    The profile of a user is the normalized sum of the feature vectors of the titles
+    the user liked, computed for all users with one sparse matrix product.
+
+    space: FeatureSpace
+    liked: list of lists of tconst, one list per user
+
+    return: tuple (profiles, seen) of csr_matrix (users x features) and (users x titles)
+    '''
+    seen = liked_matrix(space, liked)
+    profiles = normalize_rows(seen @ space.matrix)
+    return profiles, seen
+
+
+def recommend(space, liked, k=10, batch_size=64, popularity_weight=0.1):
+    '''Score the whole catalogue for many users and return their top k titles
+
+    Users are scored in batches of batch_size: the dense block of the profiles is
+    multiplied with the dense features of the catalogue, the sparse remainder is added
+    with one sparse matrix product. Already liked titles are masked out and
+    np.argpartition selects the top k without sorting the catalogue. batch_size bounds
+    the memory of the score block (batch_size x titles).
+
+    space: FeatureSpace
+    liked: list of lists of tconst, one list per user
+    k: int number of recommendations per user
+    batch_size: int number of users which are scored together
+    popularity_weight: float weight of the rating prior added to the similarity
+
+    return: pandas dataframe with the columns user, rank, tconst, score
+    '''
+    k = min(k, len(space))
+    profiles, seen = build_profiles(space, liked)
+    profiles_dense = profiles[:, :space.n_dense].toarray()
+    profiles_sparse = profiles[:, space.n_dense:].tocsr()
+    prior = space.popularity * np.float32(popularity_weight)
+
+    users, top, top_scores = [], [], []
+    for start in range(0, len(liked), batch_size):
+        end = min(start + batch_size, len(liked))
+
+        scores = profiles_dense[start:end] @ space.dense_t
+        scores += prior
+        sparse_scores = (profiles_sparse[start:end] @ space.sparse_t).tocoo()
+        scores[sparse_scores.row, sparse_scores.col] += sparse_scores.data
+        batch_seen = seen[start:end]
+        scores[np.repeat(np.arange(end - start), np.diff(batch_seen.indptr)), batch_seen.indices] = -np.inf
+
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1)
+
+        users.append(np.repeat(np.arange(start, end), k))
+        top.append(np.take_along_axis(candidates, order, axis=1).ravel())
+        top_scores.append(np.take_along_axis(candidate_scores, order, axis=1).ravel())
+
+    if not users:
+        return pd.DataFrame(columns=['user', 'rank', 'tconst', 'score'])
+
+    result = pd.DataFrame({
+        'user': np.concatenate(users),
+        'rank': np.tile(np.arange(1, k + 1), len(liked)),
+        'tconst': space.tconsts[np.concatenate(top)],
+        'score': np.concatenate(top_scores),
+    })
+    # users with less than k unseen titles get -inf fillers, drop them
+    return result[np.isfinite(result['score'])].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s :: %(asctime)s :: %(message)s')
+
+    sql_user = 'root'
+    sql_pass = 'myrootpassword'
+    sql_host = 'localhost'
+    sql_db = 'mrdatabase'
+
+    logging.info("connect to Database")
+    db_connection_str = f'mysql+pymysql://{sql_user}:{sql_pass}@{sql_host}/{sql_db}?charset=utf8mb4'
+    db_engine = sa.create_engine(db_connection_str)
+
+    now = datetime.datetime.now()
+    with db_engine.connect() as db_connection:
+        space = load_feature_space(db_connection)
+    logging.info(f"Feature space built in {datetime.datetime.now() - now}")
+
+    # users who liked random samples of the catalogue, only to measure the throughput
+    rng = np.random.default_rng(0)
+    n_users = int(os.environ.get('MR_BENCH_USERS', 1000))
+    liked = [list(space.tconsts[rng.choice(len(space), 30, replace=False)]) for _ in range(n_users)]
+
+    now = datetime.datetime.now()
+    recommendations = recommend(space, liked, k=10)
+    elapsed = (datetime.datetime.now() - now).total_seconds()
+    logging.info(f"Scored {n_users} users in {elapsed:.2f}s ({n_users / elapsed:.0f} users/s)")
+    logging.info(recommendations.head(10))